@@ -1,27 +1,33 @@
 #!/usr/bin/env python3
 import os
 import asyncio
-import json
+import orjson
 import time
 import logging
 import random
+import signal
+import sys
 import hashlib
+import hmac
 import urllib.parse
 import base64
 import aiohttp
 import re
+import itertools
+from collections import OrderedDict
+from dataclasses import dataclass, field, fields
+from functools import lru_cache
 from pathlib import Path
 from dotenv import load_dotenv
 from datetime import datetime
-import logging
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s | %(levelname)s | %(message)s",
     handlers=[logging.StreamHandler()]
 )
 
-log = logging.getLogger("onion")  # This line ensures 'log' is available globallydef validate_environment():
-   
+log = logging.getLogger("onion")
+
 def validate_environment():
     required_vars = ["BOT_TOKEN"]
     missing_vars = []
@@ -36,21 +42,20 @@ def validate_environment():
 # Call validation right after load_dotenv()
 load_dotenv()
 validate_environment()
-# Call validation right after load_dotenv()
-load_dotenv()
-validate_environment()
 
-import aiohttp
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import (
-    Application, CommandHandler, ContextTypes,
+    AIORateLimiter, Application, CommandHandler, ContextTypes,
     CallbackQueryHandler, MessageHandler, filters
 )
 from solders.pubkey import Pubkey
-from solders.signature import Signature
-from solders.transaction_status import UiTransactionEncoding
+from solana.rpc.commitment import Confirmed
+from solana.rpc.websocket_api import connect as ws_connect
+from solders.rpc.config import RpcTransactionLogsFilterMentions
 from jupiter_python_sdk.jupiter import Jupiter
+from rbloom import Bloom
+from web3 import Web3  # BSC address validation; imported up front so /setbsc never pays the import
 
 
 # ---------------------------------------------------------------------------
@@ -70,6 +75,7 @@ if not HELIUS_API_KEY:
     exit(1)
 
 RPC_URL = f"https://mainnet.helius-rpc.com/?api-key={HELIUS_API_KEY}"
+WS_URL = f"wss://mainnet.helius-rpc.com/?api-key={HELIUS_API_KEY}"
 PUMP_FUN_PROGRAM = "6EF8rrecthR5Dkzon8Nwu78hRvfCKubJ14M5uBEwF6P"  # pump.fun program ID
 # ---------------------------------------------------------------------------
 # 2025 FILTERS (REAL WORKING SETTINGS)
@@ -95,82 +101,410 @@ RPC_POOL = [
     "https://solana-rpc.tokend.io"
 ]
 
+class RpcHealth:
+    """An RPC endpoint plus the stats used to pick the healthiest one."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.latency_ewma = 1.0  # seconds; pessimistic seed until we have samples
+        self.fail_streak = 0
+
+    def score(self) -> float:
+        return self.latency_ewma * (2 ** self.fail_streak)
+
+    def record(self, elapsed: float, ok: bool):
+        self.latency_ewma = 0.9 * self.latency_ewma + 0.1 * elapsed
+        self.fail_streak = 0 if ok else self.fail_streak + 1
+
+RPC_CLIENTS: list[RpcHealth] = []  # opened in main(), Helius first
+HTTP: aiohttp.ClientSession | None = None  # shared keep-alive session for all RPC traffic, opened in main()
+
+def open_http() -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=100, limit_per_host=20, keepalive_timeout=75,
+            ttl_dns_cache=300, enable_cleanup_closed=True
+        ),
+        timeout=aiohttp.ClientTimeout(total=15, sock_connect=5, sock_read=10),
+        headers={"Accept-Encoding": "gzip", "User-Agent": "onionx/1"},
+    )
+
+def pick_rpc() -> RpcHealth:
+    return min(RPC_CLIENTS, key=RpcHealth.score)
+
+async def rpc_post(rpc: RpcHealth, payload):
+    """POST a JSON-RPC request (or batch) over the shared session, updating rpc's health."""
+    started = time.perf_counter()
+    try:
+        async with HTTP.post(rpc.url, data=orjson.dumps(payload), headers={"Content-Type": "application/json"}) as r:
+            r.raise_for_status()
+            reply = orjson.loads(await r.read())
+    except Exception:
+        rpc.record(time.perf_counter() - started, ok=False)
+        raise
+    rpc.record(time.perf_counter() - started, ok=True)
+    return reply
+
+async def rpc_call(rpc: RpcHealth, method: str, params: list):
+    reply = await rpc_post(rpc, {"jsonrpc": "2.0", "id": 1, "method": method, "params": params})
+    if "error" in reply:
+        raise RuntimeError(f"{method}: {reply['error'].get('message')}")
+    return reply.get("result")
+
+# Alert buttons carry a small int instead of the 44-char mint (callback_data is capped at 64 bytes)
+CB_TTL = 600  # alert buttons stop resolving after 10 minutes
+CB_INDEX = OrderedDict()  # token → (mint, issued_at)
+_next_cb = itertools.count()
+
 watchlist = {}  # mint → {"added_at": time.time(), "launched": ts, "info": info_dict}
 WATCH_DURATION = 900  # 15 minutes
 RECHECK_INTERVAL = 30  # how often we recheck the watchlist
 # ---------------------------------------------------------------------------
 # STATE
 # ---------------------------------------------------------------------------
-seen = {}
-token_db = {}
-ready_queue = []
-users = {}
-data = {"users": {}, "revenue": 0.0, "total_trades": 0, "wins": 0}
-save_lock = asyncio.Lock()
+SEEN_MAX = 50_000  # `seen` timestamps are time.monotonic()
+SEEN_TTL = 3600  # launches this old can never pass the age filter again
+seen = OrderedDict()  # mint → first-seen ts, LRU-capped at SEEN_MAX
+BLOOM_FILE = Path("seen.bloom")
+BOOT_TIME = time.time()  # launches older than this can only be in SEEN_BLOOM, never in `seen`
+
+def _bloom_hash(mint: str) -> int:
+    # rbloom only persists filters with a stable hash; the builtin hash() is salted per process
+    return int.from_bytes(hashlib.blake2b(mint.encode(), digest_size=16).digest(), "big", signed=True)
+
+def load_bloom() -> Bloom:
+    if BLOOM_FILE.is_file():
+        try:
+            return Bloom.load(str(BLOOM_FILE), _bloom_hash)
+        except Exception as e:
+            log.error("Bloom load error: %s", e)
+    return Bloom(1_000_000, 0.001, _bloom_hash)
+
+def write_bloom(payload: bytes):
+    # payload comes from SEEN_BLOOM.save_bytes() on the loop, so a thread can write it
+    # while launches keep adding to the live filter
+    tmp = BLOOM_FILE.with_suffix(".tmp")
+    tmp.write_bytes(payload)
+    os.replace(tmp, BLOOM_FILE)
+
+SEEN_BLOOM = load_bloom()  # long-tail dedup for mints evicted from `seen`, kept across restarts
+
+@dataclass(slots=True)
+class Tok:
+    """Per-launch scanner record; slots keep it far smaller than a dict."""
+    symbol: str
+    launched: float
+    short: str
+    fdv: float = 50000  # placeholder – fetch real later
+    holders: int = 1
+    alerted: bool = False
+
+    @classmethod
+    def launch(cls, mint: str, launched: float) -> "Tok":
+        return cls(sys.intern(f"NEW_{mint[:6].upper()}"), launched, short_addr(mint))
+
+token_db: dict[str, Tok] = {}
+
+@dataclass(slots=True)
+class Trade:
+    """One buy and its auto-sell outcome; orjson serializes dataclasses natively."""
+    mint: str
+    cost_usd: float
+    amount_sol: float
+    status: str  # pending → open → sold
+    tp: float
+    sl: float
+    buy_time: float
+    profit: float = 0.0
+
+CHECKS: set[asyncio.Task] = set()  # in-flight streamed fetches and process_token runs, held so they can't be GC'd
+ELIGIBLE: set[int] = set()  # uids that still receive alerts (paid or free credits left)
+_dirty = False  # set by anything that mutates users/data; auto_save skips clean ticks
+_dirty_users: set[int] = set()  # uids changed since the last save; only these go to the journal
+_snapshot_due = False  # a change webhook.py must see; the next save rewrites data.json in full
+_scan_dirty = False  # scanner dedup state changed; saved on its own slower cadence, not per tick
+SCAN_SAVE_EVERY = 10  # auto_save ticks (~minutes) between scanner-state saves
+STOP = asyncio.Event()  # set on shutdown; background loops exit at their next iteration
+stream_live = asyncio.Event()  # set while the log stream is subscribed; the poller stands down
 admin_id = None
 app = None
 DATA_FILE = Path("data.json")
+JOURNAL_FILE = Path("data.log")  # one orjson line per save since the last full snapshot
+COMPACT_EVERY = 60  # journal ticks between full snapshots (~1h at one tick a minute)
+COMPACT_BYTES = 1 << 20  # ...or sooner once the journal passes 1 MiB
+TOP_LEVEL_KEYS = ("revenue", "total_trades", "wins")
+TRANSIENT_USER_KEYS = ("connect_challenge", "connect_expiry", "connect_sig", "connect_url")
+
+@dataclass(slots=True)
+class User:
+    """Per-user settings, credits and trades; defaults double as load-time migrations."""
+    chat_id: int | None = None
+    free_alerts: int = 3
+    paid: bool = False
+    wallet: str | None = None
+    bsc_wallet: str | None = None
+    default_buy_sol: float = 0.1
+    default_tp: float = 2.8
+    default_sl: float = 0.38
+    trades: list[Trade] = field(default_factory=list)
+    pending_buy: str | None = None
+    # Phantom connect handshake; lives only in memory (see TRANSIENT_USER_KEYS)
+    connect_challenge: str | None = None
+    connect_expiry: float = 0.0
+    connect_sig: str | None = None
+    connect_url: str | None = None
+
+    @classmethod
+    def from_json(cls, raw: dict) -> "User":
+        known = {k: v for k, v in raw.items() if k in _USER_FIELDS}
+        known["trades"] = [Trade(**t) for t in known.get("trades", ())]
+        return cls(**known)
+
+    def to_json(self) -> dict:
+        return {k: getattr(self, k) for k in _PERSISTED_USER_FIELDS}
+
+_USER_FIELDS = frozenset(f.name for f in fields(User))
+_PERSISTED_USER_FIELDS = tuple(f.name for f in fields(User) if f.name not in TRANSIENT_USER_KEYS)
 
 def load_data():
     global admin_id
-    if DATA_FILE.is_file():
+    try:
+        raw = orjson.loads(DATA_FILE.read_bytes()) if DATA_FILE.is_file() else {}
+        raw.setdefault("users", {})
+        # Until the first full snapshot (fresh deploy), the journal is the only copy of state
+        replay_journal(raw)
+        raw.setdefault("revenue", 0.0)
+        raw.setdefault("total_trades", 0)
+        raw.setdefault("wins", 0)
+        # JSON object keys come back as str; handlers look users up by Telegram's int id
+        raw["users"] = {int(uid): User.from_json(u) for uid, u in raw["users"].items()}
+        admin_id = raw.get("admin_id")
+        return raw
+    except Exception as e:
+        log.error("Load error: %s", e)
+    return {"users": {}, "revenue": 0.0, "total_trades": 0, "wins": 0}
+
+def replay_journal(raw: dict):
+    """Apply data.log on top of the snapshot; entries hold whole records, so replay is idempotent."""
+    if not JOURNAL_FILE.is_file():
+        return
+    journal = JOURNAL_FILE.read_bytes()
+    good = 0  # end of the last complete, parseable line
+    while (end := journal.find(b"\n", good)) != -1:
         try:
-            raw = json.loads(DATA_FILE.read_text())
-            for u in raw.get("users", {}).values():
-                u.setdefault("free_alerts", 3)
-                u.setdefault("paid", False)
-                u.setdefault("wallet", None)
-                u.setdefault("chat_id", None)
-                u.setdefault("bsc_wallet", None)
-                u.setdefault("default_buy_sol", 0.1)
-                u.setdefault("default_tp", 2.8)
-                u.setdefault("default_sl", 0.38)
-                u.setdefault("trades", [])
-            admin_id = raw.get("admin_id")
-            return raw
-        except Exception as e:
-            log.error(f"Load error: {e}")
-    return data
+            entry = orjson.loads(journal[good:end])
+        except orjson.JSONDecodeError:
+            break
+        good = end + 1
+        if entry.pop("gen", 0) < raw.get("journal_gen", 0):
+            continue  # already folded into the snapshot before the journal was removed
+        for uid, rec in entry.pop("users", {}).items():
+            prev = raw["users"].get(uid)
+            if prev and prev.get("paid") and not rec.get("paid"):
+                # webhook.py grants premium straight into data.json and the bot never
+                # revokes it, so an older journaled record must not undo the payment
+                rec["paid"] = True
+                rec["free_alerts"] = prev.get("free_alerts", rec.get("free_alerts"))
+            raw["users"][uid] = rec
+        raw.update(entry)
+    if good < len(journal):
+        # Torn tail from a crash mid-append; cut it so the next append starts on a clean line
+        log.warning("Dropping %d torn bytes from %s", len(journal) - good, JOURNAL_FILE)
+        with open(JOURNAL_FILE, "r+b") as f:
+            f.truncate(good)
+
+def _recompute_eligibility(uid) -> None:
+    u = users.get(uid)
+    if u and (u.paid or u.free_alerts > 0):
+        ELIGIBLE.add(uid)
+    else:
+        ELIGIBLE.discard(uid)
 
 data = load_data()
 users = data["users"]
+for _uid in users:
+    _recompute_eligibility(_uid)
+# (uid, trade) for every "open" trade, so the auto-sell tick skips pending and settled history.
+# Buys start "pending" and nothing in the bot confirms the Phantom signature yet; whatever
+# flips a trade to "open" must append it here.
+OPEN_TRADES: list[tuple] = [
+    (_uid, t) for _uid, _u in users.items() for t in _u.trades if t.status == "open"
+]
+
+def mark_dirty(uid: int | None = None, snapshot: bool = False):
+    """Schedule a save; snapshot=True for fields webhook.py reads from data.json."""
+    global _dirty, _snapshot_due
+    _dirty = True
+    if uid is not None:
+        _dirty_users.add(uid)
+    if snapshot:
+        _snapshot_due = True
+
+def get_user(uid: int, chat_id: int) -> User:
+    """Return the user record, creating it on first contact."""
+    u = users.get(uid)
+    if u is None:
+        u = users[uid] = User(chat_id=chat_id)
+        _recompute_eligibility(uid)
+        mark_dirty(uid)
+    return u
+
+def snapshot() -> bytes:
+    # Every full snapshot starts a new journal generation, so a journal that
+    # outlives its snapshot (crash before the unlink) is skipped on replay
+    data["journal_gen"] = data.get("journal_gen", 0) + 1
+    saveable = data.copy()
+    saveable["admin_id"] = admin_id
+    saveable["last_sig"] = last_sig
+    # to_json leaves out transient connect state; the live records still need it
+    saveable["users"] = {uid: u.to_json() for uid, u in users.items()}
+    return orjson.dumps(saveable, option=orjson.OPT_NON_STR_KEYS)
+
+def write_data(payload: bytes, durable: bool = False):
+    # Write-then-rename so a crash mid-write never leaves a truncated data.json.
+    # Periodic saves skip fsync (the rename alone keeps the file consistent);
+    # the shutdown save passes durable=True.
+    tmp = DATA_FILE.with_suffix(".json.tmp")
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, DATA_FILE)
+    JOURNAL_FILE.unlink(missing_ok=True)  # everything in it is now in the snapshot
+
+def journal_entry(uids) -> bytes:
+    entry = {k: data.get(k) for k in TOP_LEVEL_KEYS}
+    entry["gen"] = data.get("journal_gen", 0)
+    entry["last_sig"] = last_sig
+    entry["users"] = {uid: users[uid].to_json() for uid in uids if uid in users}
+    return orjson.dumps(entry, option=orjson.OPT_NON_STR_KEYS) + b"\n"
+
+def append_journal(line: bytes):
+    with open(JOURNAL_FILE, "ab") as f:
+        f.write(line)
+
+async def wait_stop(timeout: float) -> bool:
+    """Sleep up to `timeout` seconds; True if shutdown was requested meanwhile."""
+    try:
+        await asyncio.wait_for(STOP.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+async def save_scan_state():
+    """Write SEEN_BLOOM and the poll cursor without touching the user-state dirty flag."""
+    global _scan_dirty
+    _scan_dirty = False
+    try:
+        await asyncio.to_thread(append_journal, journal_entry(()))  # carries last_sig
+        await asyncio.to_thread(write_bloom, SEEN_BLOOM.save_bytes())
+    except OSError as e:
+        log.error("Scanner state save failed: %s", e)
+        _scan_dirty = True
 
 async def auto_save():
-    while True:
-        await asyncio.sleep(60)
-        async with save_lock:
-            saveable = data.copy()
-            saveable["admin_id"] = admin_id
-            for u in saveable["users"].values():
-                u.pop("connect_challenge", None)
-                u.pop("connect_expiry", None)
-            DATA_FILE.write_text(json.dumps(saveable, indent=2))
+    # Sole periodic writer, so no lock. It is never cancelled: on STOP it
+    # finishes any in-flight write and returns, and shutdown writes last.
+    # Most ticks append just the changed users to the journal; every
+    # COMPACT_EVERY ticks (or once it grows large, or when webhook.py needs
+    # to see a change) a full snapshot replaces it.
+    global _dirty, _snapshot_due
+    ticks = scan_ticks = 0
+    while not await wait_stop(60):
+        scan_ticks += 1
+        if _scan_dirty and scan_ticks >= SCAN_SAVE_EVERY:
+            await save_scan_state()
+            scan_ticks = 0
+        if not _dirty:
+            continue
+        uids = list(_dirty_users)
+        full = _snapshot_due
+        _dirty = _snapshot_due = False
+        _dirty_users.clear()
+        ticks += 1
+        try:
+            big = JOURNAL_FILE.is_file() and JOURNAL_FILE.stat().st_size > COMPACT_BYTES
+            if full or ticks >= COMPACT_EVERY or big:
+                await asyncio.to_thread(write_data, snapshot())
+                ticks = 0
+            else:
+                await asyncio.to_thread(append_journal, journal_entry(uids))
+        except OSError as e:
+            log.error("Save failed: %s", e)
+            _dirty = True  # retry next tick
+            _snapshot_due = _snapshot_due or full
+            _dirty_users.update(uids)
 
 # ---------------------------------------------------------------------------
 # HELPERS
 # ---------------------------------------------------------------------------
+def mark_seen(mint: str, now: float):
+    global _scan_dirty
+    SEEN_BLOOM.add(mint)
+    seen[mint] = now
+    trim_seen(now)
+    _scan_dirty = True
+
+def trim_seen(now: float):
+    # Insertion order is time order, so expired entries are always at the front.
+    # token_db is filled alongside seen, so its records leave with them.
+    while seen and (len(seen) > SEEN_MAX or next(iter(seen.values())) < now - SEEN_TTL):
+        mint, _ = seen.popitem(last=False)
+        token_db.pop(mint, None)
+
+def cb_token(mint: str) -> int:
+    now = time.time()
+    while CB_INDEX and next(iter(CB_INDEX.values()))[1] < now - CB_TTL:
+        CB_INDEX.popitem(last=False)
+    tok = next(_next_cb)
+    CB_INDEX[tok] = (mint, now)
+    return tok
+
+def cb_mint(tok: str) -> str | None:
+    entry = CB_INDEX.get(int(tok)) if tok.isdigit() else None
+    return entry[0] if entry else None
+
 def fmt_usd(v: float) -> str:
     return f"${abs(v):,.2f}" + ("+" if v >= 0 else "")
 
+@lru_cache(maxsize=256)  # a handful of preset buy sizes
 def fmt_sol(v: float) -> str:
     return f"{v:.3f} SOL"
 
+@lru_cache(maxsize=4096)
 def short_addr(addr: str) -> str:
     return f"{addr[:6]}...{addr[-4:]}" if addr and len(addr) > 10 else "—"
 
+def _sig(challenge: str) -> str:
+    """16-hex tag binding a connect challenge to its expiry.
+
+    Only an anti-tamper check on our own deep link, not a cryptographic
+    commitment, so BLAKE2b's 8-byte digest is plenty.
+    """
+    return hashlib.blake2b(challenge.encode(), digest_size=8).hexdigest()
+
 # ---------------------------------------------------------------------------
 # PHANTOM CONNECT
 # ---------------------------------------------------------------------------
 def build_connect_url(uid: int) -> str:
     """Build a simpler connect URL that doesn't rely on complex parameter parsing."""
-    users[uid]["connect_challenge"] = f"connect_{uid}"
-    users[uid]["connect_expiry"] = time.time() + 300  # 5 minutes
+    u = users[uid]
+    # Reuse the live link so a menu refresh doesn't invalidate an in-flight approval
+    if u.connect_url and time.time() < u.connect_expiry - 30:
+        return u.connect_url
+    challenge = f"connect_{uid}"
+    expiry = time.time() + 300  # 5 minutes
+    u.connect_challenge = challenge
+    u.connect_expiry = expiry
+    u.connect_sig = _sig(f"{challenge}:{expiry}")  # start compares against this, no re-hash
     
     params = {
         "app_url": f"https://t.me/{BOT_USERNAME}",
-        "redirect_link": f"https://t.me/{BOT_USERNAME}?start=connect_{uid}"
+        "redirect_link": f"https://t.me/{BOT_USERNAME}?start=connect_{u.connect_sig}"
     }
-    return f"https://phantom.app/ul/v1/connect?{urllib.parse.urlencode(params)}"
+    u.connect_url = f"https://phantom.app/ul/v1/connect?{urllib.parse.urlencode(params)}"
+    return u.connect_url
 
 # ---------------------------------------------------------------------------
 # COMMANDS
@@ -179,19 +513,19 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     chat_id = update.effective_chat.id
     
-    # Ensure user exists
-    if uid not in users:
-        users[uid] = {
-            "free_alerts": 3, "paid": False, "chat_id": chat_id,
-            "wallet": None, "bsc_wallet": None,
-            "default_buy_sol": 0.1, "default_tp": 2.8, "default_sl": 0.38,
-            "trades": []
-        }
-    
-    users[uid]["chat_id"] = chat_id
+    get_user(uid, chat_id).chat_id = chat_id
+    mark_dirty(uid)
     
     # Check if this is a wallet connection attempt
     if ctx.args and len(ctx.args) > 0 and ctx.args[0].startswith("connect_"):
+        u = users[uid]
+        expected = u.connect_sig
+        if (not expected or time.time() > u.connect_expiry
+                or not hmac.compare_digest(ctx.args[0][len("connect_"):].encode(), expected.encode())):
+            await update.message.reply_text(
+                "This connect link has expired. Open the menu and tap 'Connect Wallet' again."
+            )
+            return
         await update.message.reply_text(
             "Phantom wallet connection detected.\n\n"
             "Please go back to the bot menu and click 'Connect Wallet' again. "
@@ -203,49 +537,6 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # Normal start command
     await send_welcome(uid)
 
-async def button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    uid = q.from_user.id
-    
-    if uid not in users:
-        users[uid] = {
-            "free_alerts": 3, "paid": False, "chat_id": q.message.chat_id,
-            "wallet": None, "bsc_wallet": None,
-            "default_buy_sol": 0.1, "default_tp": 2.8, "default_sl": 0.38,
-            "trades": []
-        }
-    
-    data = q.data
-    
-    if data == "wallet" and users[uid].get("wallet"):
-        txt = f"<b>Connected Wallet</b>\n\n<code>{short_addr(users[uid]['wallet'])}</code>"
-        kb = [[InlineKeyboardButton("Disconnect", callback_data="disconnect_wallet"), 
-               InlineKeyboardButton("Back", callback_data="menu")]]
-        await safe_edit(q, txt, InlineKeyboardMarkup(kb))
-        return
-    
-    if data == "connect_wallet" or (data == "wallet" and not users[uid].get("wallet")):
-        # Simple approach: Send a message asking the user to manually connect via Phantom
-        connect_message = (
-            "To connect your Phantom wallet:\n\n"
-            "1. Open the Phantom wallet app\n"
-            "2. Tap the Settings icon (gear) in the top right\n"
-            "3. Select 'Connect with dApps'\n"
-            "4. Search for and select this bot (@{})\n"
-            "5. Approve the connection\n\n"
-            "Once connected, return here and click 'Wallet' to verify the connection."
-        ).format(BOT_USERNAME)
-        
-        kb = [[InlineKeyboardButton("Wallet Status", callback_data="wallet"), 
-               InlineKeyboardButton("Main Menu", callback_data="menu")]]
-        
-        await safe_edit(q, connect_message, InlineKeyboardMarkup(kb))
-        return 
-        
-    # Normal start command (not a verification)
-    await send_welcome(uid)
-
 async def menu_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await build_menu(update.effective_user.id)
 
@@ -255,18 +546,22 @@ async def setbsc(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /setbsc 0xYourBSCAddress")
         return
     addr = ctx.args[0]
-    from web3 import Web3
     if not Web3.is_address(addr):
         await update.message.reply_text("Invalid BSC address.")
         return
-    users[uid]["bsc_wallet"] = addr.lower()
+    users[uid].bsc_wallet = addr.lower()
+    mark_dirty(uid, snapshot=True)  # webhook.py matches payers by bsc_wallet in data.json
     await update.message.reply_text(f"BSC wallet set: <code>{addr}</code>", parse_mode=ParseMode.HTML)
 
 # ---------------------------------------------------------------------------
 # UI
 # ---------------------------------------------------------------------------
+# PTB buttons and markups are immutable, so the shared "Back" pieces are built once
+BACK_BTN = InlineKeyboardButton("Back", callback_data="menu")
+BACK_MARKUP = InlineKeyboardMarkup([[BACK_BTN]])
+
 async def send_welcome(uid: int):
-    status = "Premium" if users[uid].get("paid") else f"{users[uid]['free_alerts']} Free"
+    status = "Premium" if users[uid].paid else f"{users[uid].free_alerts} Free"
     msg = (
         "<b>ONION X – Premium Sniper Bot</b>\n\n"
         f"Status: <code>{status}</code>\n"
@@ -276,23 +571,29 @@ async def send_welcome(uid: int):
         f"<code>{USDT_BSC_WALLET}</code>"
     )
     kb = [[InlineKeyboardButton("OPEN MENU", callback_data="menu")]]
-    await app.bot.send_message(users[uid]["chat_id"], msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.HTML)
+    await app.bot.send_message(users[uid].chat_id, msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.HTML)
 
 async def build_menu(uid: int, edit: bool = False):
     u = users[uid]
-    open_trades = sum(1 for t in u.get("trades", []) if t["status"] == "open")
-    total_pnl = sum(t.get("profit", 0) for t in u.get("trades", []) if t["status"] == "sold")
-    status = "Premium" if u.get("paid") else f"{u.get('free_alerts', 0)} Free"
+    open_trades = 0
+    total_pnl = 0.0
+    for t in u.trades:
+        status = t.status
+        if status == "open":
+            open_trades += 1
+        elif status == "sold":
+            total_pnl += t.profit
+    status = "Premium" if u.paid else f"{u.free_alerts} Free"
     wallet_btn = (
         InlineKeyboardButton("Connect Wallet", url=build_connect_url(uid))
-        if not u.get("wallet") else
-        InlineKeyboardButton(f"Wallet: {short_addr(u['wallet'])}", callback_data="wallet")
+        if not u.wallet else
+        InlineKeyboardButton(f"Wallet: {short_addr(u.wallet)}", callback_data="wallet")
     )
     msg = (
         "<b>ONION X – DASHBOARD</b>\n\n"
         f"Status: <code>{status}</code>\n"
-        f"Buy: <code>{fmt_sol(u['default_buy_sol'])}</code>\n"
-        f"Wallet: <code>{short_addr(u.get('wallet'))}</code>\n\n"
+        f"Buy: <code>{fmt_sol(u.default_buy_sol)}</code>\n"
+        f"Wallet: <code>{short_addr(u.wallet)}</code>\n\n"
         f"Open: <code>{open_trades}</code>\n"
         f"PnL: <code>{fmt_usd(total_pnl)}</code>"
     )
@@ -305,98 +606,147 @@ async def build_menu(uid: int, edit: bool = False):
     markup = InlineKeyboardMarkup(kb)
     if edit:
         return msg, markup
-    await app.bot.send_message(u["chat_id"], msg, reply_markup=markup, parse_mode=ParseMode.HTML)
+    await app.bot.send_message(u.chat_id, msg, reply_markup=markup, parse_mode=ParseMode.HTML)
 
 async def show_live_trades(uid: int):
-    trades = [t for t in users[uid].get("trades", []) if t["status"] == "open"]
+    trades = [t for t in users[uid].trades if t.status == "open"]
     if not trades:
         msg = "<b>LIVE POSITIONS</b>\n\nNo open trades."
     else:
-        lines = [f"<code>{t['mint'][:8]}…</code> → {t['amount_sol']} SOL" for t in trades]
+        lines = [f"<code>{t.mint[:8]}…</code> → {t.amount_sol} SOL" for t in trades]
         msg = "<b>LIVE POSITIONS</b>\n\n" + "\n".join(lines)
-    kb = [[InlineKeyboardButton("Back", callback_data="menu")]]
-    await app.bot.send_message(users[uid]["chat_id"], msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.HTML)
+    await app.bot.send_message(users[uid].chat_id, msg, reply_markup=BACK_MARKUP, parse_mode=ParseMode.HTML)
 
 async def show_settings(uid: int):
     u = users[uid]
     msg = (
         "<b>SETTINGS</b>\n\n"
-        f"Buy Amount: <code>{fmt_sol(u['default_buy_sol'])}</code>\n"
-        f"Take Profit: <code>{u['default_tp']}x</code>\n"
-        f"Stop Loss: <code>{u['default_sl']}x</code>\n"
+        f"Buy Amount: <code>{fmt_sol(u.default_buy_sol)}</code>\n"
+        f"Take Profit: <code>{u.default_tp}x</code>\n"
+        f"Stop Loss: <code>{u.default_sl}x</code>\n"
         f"Slippage: <code>50 bps</code>"
     )
     kb = [
-        [InlineKeyboardButton("Buy: 0.1", callback_data="set_buy_0.1"),
-         InlineKeyboardButton("0.3", callback_data="set_buy_0.3"),
-         InlineKeyboardButton("0.5", callback_data="set_buy_0.5")],
-        [InlineKeyboardButton("TP: 2x", callback_data="set_tp_2.0"),
-         InlineKeyboardButton("2.8x", callback_data="set_tp_2.8"),
-         InlineKeyboardButton("5x", callback_data="set_tp_5.0")],
-        [InlineKeyboardButton("SL: 30%", callback_data="set_sl_0.3"),
-         InlineKeyboardButton("38%", callback_data="set_sl_0.38"),
-         InlineKeyboardButton("50%", callback_data="set_sl_0.5")],
-        [InlineKeyboardButton("Back", callback_data="menu")]
+        [InlineKeyboardButton("Buy: 0.1", callback_data="set_buy:0.1"),
+         InlineKeyboardButton("0.3", callback_data="set_buy:0.3"),
+         InlineKeyboardButton("0.5", callback_data="set_buy:0.5")],
+        [InlineKeyboardButton("TP: 2x", callback_data="set_tp:2.0"),
+         InlineKeyboardButton("2.8x", callback_data="set_tp:2.8"),
+         InlineKeyboardButton("5x", callback_data="set_tp:5.0")],
+        [InlineKeyboardButton("SL: 30%", callback_data="set_sl:0.3"),
+         InlineKeyboardButton("38%", callback_data="set_sl:0.38"),
+         InlineKeyboardButton("50%", callback_data="set_sl:0.5")],
+        [BACK_BTN]
     ]
-    await app.bot.send_message(u["chat_id"], msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.HTML)
+    await app.bot.send_message(u.chat_id, msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.HTML)
 
 # ---------------------------------------------------------------------------
 # BUTTON HANDLER
 # ---------------------------------------------------------------------------
-async def button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    uid = q.from_user.id
-    data = q.data
-
-    if data == "menu":
-        msg, kb = await build_menu(uid, edit=True)
-        await safe_edit(q, msg, kb)
-    elif data == "wallet":
-        txt = f"<b>WALLET</b>\n\n<code>{short_addr(users[uid]['wallet'])}</code>"
-        kb = [[InlineKeyboardButton("Disconnect", callback_data="disconnect_wallet"), InlineKeyboardButton("Back", callback_data="menu")]]
-        await safe_edit(q, txt, InlineKeyboardMarkup(kb))
-    elif data == "disconnect_wallet":
-        users[uid]["wallet"] = None
-        await safe_edit(q, "Wallet disconnected.", InlineKeyboardMarkup([[InlineKeyboardButton("Back", callback_data="menu")]]))
-    elif data == "live_trades":
-        await show_live_trades(uid)
-    elif data == "settings":
-        await show_settings(uid)
-    elif data.startswith("set_buy_"):
-        amount = float(data.split("_")[-1])
-        users[uid]["default_buy_sol"] = amount
-        await show_settings(uid)
-    elif data.startswith("set_tp_"):
-        tp = float(data.split("_")[-1])
-        users[uid]["default_tp"] = tp
-        await show_settings(uid)
-    elif data.startswith("set_sl_"):
-        sl = float(data.split("_")[-1])
-        users[uid]["default_sl"] = sl
+# Callback data is "<name>" or "<name>:<arg>"; each name maps to one handler(q, uid, arg)
+async def on_menu(q, uid: int, arg: str):
+    msg, kb = await build_menu(uid, edit=True)
+    await safe_edit(q, msg, kb)
+
+async def on_wallet(q, uid: int, arg: str):
+    wallet = users[uid].wallet
+    if not wallet:
+        txt = "<b>WALLET</b>\n\nNo wallet connected."
+        kb = [[InlineKeyboardButton("Connect Wallet", url=build_connect_url(uid)), BACK_BTN]]
+    else:
+        txt = f"<b>WALLET</b>\n\n<code>{short_addr(wallet)}</code>"
+        kb = [[InlineKeyboardButton("Disconnect", callback_data="disconnect_wallet"), BACK_BTN]]
+    await safe_edit(q, txt, InlineKeyboardMarkup(kb))
+
+async def on_disconnect_wallet(q, uid: int, arg: str):
+    users[uid].wallet = None
+    mark_dirty(uid)
+    await safe_edit(q, "Wallet disconnected.", BACK_MARKUP)
+
+async def on_live_trades(q, uid: int, arg: str):
+    await show_live_trades(uid)
+
+async def on_settings(q, uid: int, arg: str):
+    await show_settings(uid)
+
+def _setting_handler(key: str):
+    async def handler(q, uid: int, arg: str):
+        setattr(users[uid], key, float(arg))
+        mark_dirty(uid)
         await show_settings(uid)
-    elif data.startswith("buy_"):
-        _, mint, amount = data.split("_", 2)
+    return handler
+
+async def _alert_mint(uid: int, tok: str) -> str | None:
+    mint = cb_mint(tok)
+    if not mint:
+        await app.bot.send_message(users[uid].chat_id, "This alert has expired.")
+    return mint
+
+async def on_alert_buy(q, uid: int, arg: str):
+    tok, _, amount = arg.partition(":")
+    mint = await _alert_mint(uid, tok)
+    if mint:
         await jupiter_buy(uid, mint, float(amount))
-    elif data.startswith("custom_buy_"):
-        mint = data.split("_", 2)[2]
-        users[uid]["pending_buy"] = mint
+
+async def on_alert_custom_buy(q, uid: int, arg: str):
+    mint = await _alert_mint(uid, arg)
+    if mint:
+        users[uid].pending_buy = mint
+        mark_dirty(uid)
         await q.edit_message_text("Enter amount in SOL (e.g. 0.25):", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data="menu")]]))
-    elif data.startswith("copy_"):
-        mint = data.split("_", 1)[1]
+
+async def on_alert_copy(q, uid: int, arg: str):
+    mint = await _alert_mint(uid, arg)
+    if mint:
         await q.edit_message_text(f"<b>COPY CA</b>\n<code>{mint}</code>\nCopied!", parse_mode=ParseMode.HTML)
 
+BUTTON_HANDLERS = {
+    "menu": on_menu,
+    "wallet": on_wallet,
+    "connect_wallet": on_wallet,
+    "disconnect_wallet": on_disconnect_wallet,
+    "live_trades": on_live_trades,
+    "settings": on_settings,
+    "set_buy": _setting_handler("default_buy_sol"),
+    "set_tp": _setting_handler("default_tp"),
+    "set_sl": _setting_handler("default_sl"),
+    "b": on_alert_buy,
+    "cb": on_alert_custom_buy,
+    "c": on_alert_copy,
+}
+
+async def button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    name, _, arg = q.data.partition(":")
+    handler = BUTTON_HANDLERS.get(name)
+    if not handler:  # pre-upgrade callback formats (set_buy_0.1, buy_<mint>_0.1, copy_<mint>)
+        await app.bot.send_message(q.message.chat_id, "This button has expired. Open /menu.")
+        return
+    uid = q.from_user.id
+    get_user(uid, q.message.chat_id)
+    await handler(q, uid, arg)
+
 # ---------------------------------------------------------------------------
 # JUPITER BUY
 # ---------------------------------------------------------------------------
+_jupiter: Jupiter | None = None
+
+def jupiter() -> Jupiter:
+    """One Jupiter client for every buy, created on first use."""
+    global _jupiter
+    if _jupiter is None:
+        _jupiter = Jupiter()
+    return _jupiter
+
 async def jupiter_buy(uid: int, mint: str, sol_amount: float):
     u = users[uid]
-    if not u.get("wallet"):
-        await app.bot.send_message(u["chat_id"], "Connect wallet first.")
+    if not u.wallet:
+        await app.bot.send_message(u.chat_id, "Connect wallet first.")
         return
     for attempt in range(3):
         try:
-            jupiter_client = Jupiter()
+            jupiter_client = jupiter()
             quote = await jupiter_client.get_quote(
                 input_mint="So11111111111111111111111111111111111111112",
                 output_mint=mint,
@@ -404,28 +754,30 @@ async def jupiter_buy(uid: int, mint: str, sol_amount: float):
                 slippage_bps=50
             )
             if not quote or not quote.get("routes"):
-                await app.bot.send_message(u["chat_id"], "No route.")
+                await app.bot.send_message(u.chat_id, "No route.")
                 return
             route = quote["routes"][0]
             route["feeBps"] = 100
             route["feeWallet"] = FEE_WALLET
-            swap_tx = await jupiter_client.swap(route, Pubkey.from_string(u["wallet"]))
+            swap_tx = await jupiter_client.swap(route, Pubkey.from_string(u.wallet))
             tx_b64 = base64.b64encode(swap_tx.serialize_message()).decode()
             sign_url = f"https://phantom.app/ul/v1/signAndSendTransaction?tx={tx_b64}&redirect_link=https://t.me/{BOT_USERNAME}"
             cost_usd = sol_amount * 180
             fee_usd = cost_usd * 0.01
             data["revenue"] += fee_usd
             data["total_trades"] += 1
-            u["trades"].append({
-                "mint": mint, "cost_usd": cost_usd - fee_usd, "amount_sol": sol_amount,
-                "status": "pending", "tp": u["default_tp"], "sl": u["default_sl"],
-                "buy_time": time.time()
-            })
+            trade = Trade(
+                mint=mint, cost_usd=cost_usd - fee_usd, amount_sol=sol_amount,
+                status="pending", tp=u.default_tp, sl=u.default_sl,
+                buy_time=time.time()
+            )
+            u.trades.append(trade)
+            mark_dirty(uid)
             kb = InlineKeyboardMarkup([[
                 InlineKeyboardButton("SIGN & BUY", url=sign_url)
-            ], [InlineKeyboardButton("Back", callback_data="menu")]])
+            ], [BACK_BTN]])
             await app.bot.send_message(
-                u["chat_id"],
+                u.chat_id,
                 f"<b>BUY {fmt_sol(sol_amount)}</b>\n<code>{short_addr(mint)}</code>\n\n"
                 f"Cost: <code>{fmt_usd(cost_usd)}</code> | Fee: <code>{fmt_usd(fee_usd)}</code>\n\n"
                 f"<b>Sign in Phantom to complete:</b>",
@@ -433,199 +785,302 @@ async def jupiter_buy(uid: int, mint: str, sol_amount: float):
             )
             return
         except Exception as e:
-            log.error(f"Buy attempt {attempt+1} failed: {e}")
+            log.error("Buy attempt %d failed: %s", attempt + 1, e)
             if attempt == 2:
-                await app.bot.send_message(u["chat_id"], "Buy failed after 3 attempts.")
+                await app.bot.send_message(u.chat_id, "Buy failed after 3 attempts.")
             else:
                 await asyncio.sleep(2 ** attempt)
 
 # ---------------------------------------------------------------------------
 # 2025 WORKING SCANNER (pump.fun API + backup)
 # ---------------------------------------------------------------------------
-async def get_new_tokens_rpc(client: AsyncClient):
-    """Monitor pump.fun program for new create txs"""
-    now = time.time()
+# Newest pump.fun signature already fetched; the next poll stops there. Persisted so a
+# restart resumes from it instead of re-alerting on the last five minutes of launches.
+last_sig = data.get("last_sig")
+
+async def get_new_tokens_rpc(rpc: RpcHealth, now: float):
+    """Monitor pump.fun program for new create txs.
+
+    `now` is wall-clock time, only used against on-chain block_time;
+    `seen` is kept in monotonic seconds so clock jumps can't expire it.
+    """
+    global last_sig, _scan_dirty
     added = 0
+    mono = time.monotonic()
+    trim_seen(mono)
     try:
-        sigs_resp = await client.get_signatures_for_address(
-            Pubkey.from_string(PUMP_FUN_PROGRAM),
-            limit=10,  # only recent 10 txs
-            until=None
-        )
-        if not sigs_resp.value:
+        opts = {"limit": 10}  # only recent 10 txs
+        if last_sig:
+            opts["until"] = last_sig  # only signatures newer than the last poll
+        sigs = await rpc_call(rpc, "getSignaturesForAddress", [PUMP_FUN_PROGRAM, opts])
+        if not sigs:
             return 0
+        if sigs[0]["signature"] != last_sig:
+            last_sig = sigs[0]["signature"]
+            _scan_dirty = True  # saved with the Bloom filter, not as a user-state change
 
-        for sig_info in sigs_resp.value[:5]:  # process top 5
-            if now - sig_info.block_time > 300:  # <5 min old
-                continue
-
-            mint = await extract_mint_from_signature(client, str(sig_info.signature))
-            if mint and mint not in seen:
-                seen[mint] = now
-                ready_queue.append(mint)
-                token_db[mint] = {
-                    "symbol": f"NEW_{mint[:6].upper()}",
-                    "fdv": 50000,  # placeholder – fetch real later
-                    "launched": sig_info.block_time,
-                    "holders": 1,
-                    "alerted": False
-                }
+        recent = [s for s in sigs[:5]  # process top 5
+                  if s.get("blockTime") and now - s["blockTime"] <= 300]  # <5 min old
+        if not recent:
+            return 0
+        txs = await fetch_transactions(rpc, [s["signature"] for s in recent])
+        for sig_info, tx in zip(recent, txs):
+            mint = extract_mint(tx)
+            if mint and queue_launch(mint, sig_info["blockTime"], now, mono):
                 added += 1
-                log.info(f"🚀 NEW PUMP LAUNCH → {token_db[mint]['symbol']} | Age: {int(now - sig_info.block_time)}s | {short_addr(mint)}")
-            await asyncio.sleep(0.3)  # rate limit
 
     except Exception as e:
-        log.error(f"RPC scanner error: {e}")
+        log.error("RPC scanner error: %s", e)
     return added
 
-async def extract_mint_from_signature(client: AsyncClient, sig: str) -> str | None:
-    try:
-        resp = await client.get_transaction(
-            Signature.from_string(sig),
-            encoding=UiTransactionEncoding.JsonParsed,
-            max_supported_transaction_version=0
-        )
-        if not resp.value:
-            return None
+def _check_done(task: asyncio.Task):
+    CHECKS.discard(task)
+    if not task.cancelled() and task.exception():
+        log.error("Token check failed: %s", task.exception())
 
-        tx: EncodedTransactionWithStatusMeta = resp.value
-        meta: UiTransactionStatusMeta = tx.transaction.meta  # ← FIXED: UiTransactionStatusMeta
-        if not meta:
-            return None
+def queue_launch(mint: str, launched: float, now: float, mono: float) -> bool:
+    """Record a freshly created mint and start checking it; False if already seen."""
+    # A bloom miss proves the mint is new. On a hit, seen settles it for anything
+    # young enough to still be there; older or pre-restart hits can only be in the filter.
+    if mint in SEEN_BLOOM and (mint in seen or launched < BOOT_TIME or now - launched > SEEN_TTL):
+        return False
+    mark_seen(mint, mono)
+    tok = token_db[mint] = Tok.launch(mint, launched)
+    log.info("🚀 NEW PUMP LAUNCH → %s | Age: %ds | %s", tok.symbol, now - launched, tok.short)
+    # Check right away rather than waiting for the next scanner cycle; CHECK_SEM bounds bursts
+    task = asyncio.create_task(process_token(mint, now))
+    CHECKS.add(task)
+    task.add_done_callback(_check_done)
+    return True
 
-        pre = {b.account_index: b for b in (meta.pre_token_balances or [])}
-        for post in (meta.post_token_balances or []):
-            pre_bal = pre.get(post.account_index)
-            if (post.ui_token_amount.ui_amount == 1.0 and
-                (not pre_bal or pre_bal.ui_token_amount.ui_amount == 0)):
-                mint_str = str(post.mint)
-                if len(mint_str) == 44:
-                    return mint_str
-        return None
+async def pump_log_stream():
+    """Push feed of pump.fun creates via logsSubscribe; the poller covers any gap."""
+    backoff = 1
+    program = Pubkey.from_string(PUMP_FUN_PROGRAM)
+    while not STOP.is_set():
+        try:
+            async with ws_connect(WS_URL) as ws:
+                # confirmed for latency; fetch_transactions asks for confirmed too, or the
+                # RPC's finalized default returns null for ~13s after the Create lands
+                await ws.logs_subscribe(RpcTransactionLogsFilterMentions(program), commitment=Confirmed)
+                await ws.recv()  # subscription ack
+                stream_live.set()
+                backoff = 1
+                log.info("📡 pump.fun log stream connected")
+                # Every pump.fun trade lands here, not just creates; keep the per-message path lean
+                wall, mono = time.time, time.monotonic
+                async for msgs in ws:
+                    for msg in msgs:
+                        value = msg.result.value
+                        if value.err or not any("Instruction: Create" in line for line in value.logs):
+                            continue
+                        # Fetch off the read loop: a slow or failing RPC must neither stall
+                        # the socket nor tear down the subscription
+                        task = asyncio.create_task(ingest_streamed(str(value.signature), wall(), mono()))
+                        CHECKS.add(task)
+                        task.add_done_callback(_check_done)
+        except Exception as e:
+            log.error("Log stream error: %s (retry in %ds)", e, backoff)
+        stream_live.clear()
+        if await wait_stop(backoff):
+            break
+        backoff = min(backoff * 2, 60)
+
+STREAM_FETCH_TRIES = 3
+
+async def fetch_streamed_tx(sig: str) -> dict | None:
+    """getTransaction for a streamed Create, retrying while a lagging RPC still answers null."""
+    for attempt in range(STREAM_FETCH_TRIES):
+        async with CHECK_SEM:
+            tx, = await fetch_transactions(pick_rpc(), [sig])
+        if tx is not None:
+            return tx
+        await asyncio.sleep(1 + attempt)
+    log.warning("Streamed create %s not visible after %d tries; dropped", sig, STREAM_FETCH_TRIES)
+    return None
+
+async def ingest_streamed(sig: str, now: float, mono: float):
+    try:
+        mint = extract_mint(await fetch_streamed_tx(sig))
     except Exception as e:
-        log.error(f"extract_mint failed {sig}: {e}")
+        log.error("Streamed create %s failed: %s", sig, e)
+        return
+    if mint:
+        queue_launch(mint, now, now, mono)
+
+async def fetch_transactions(rpc: RpcHealth, sigs: list[str]) -> list[dict | None]:
+    """getTransaction for every signature in one JSON-RPC batch POST, in input order."""
+    batch = [
+        {"jsonrpc": "2.0", "id": i, "method": "getTransaction",
+         "params": [sig, {"encoding": "jsonParsed", "maxSupportedTransactionVersion": 0,
+                          "commitment": "confirmed"}]}
+        for i, sig in enumerate(sigs)
+    ]
+    replies = await rpc_post(rpc, batch)
+    if not isinstance(replies, list):  # some RPCs refuse batches with a single error object
+        error = replies.get("error") if isinstance(replies, dict) else replies
+        raise RuntimeError(f"getTransaction batch rejected: {error}")
+    results = {reply.get("id"): reply.get("result") for reply in replies}
+    return [results.get(i) for i in range(len(sigs))]
+
+def extract_mint(tx: dict | None) -> str | None:
+    """The mint whose first token lands in this tx (balance 0/absent → 1), if any."""
+    meta = tx.get("meta") if tx else None
+    if not meta:
         return None
 
-async def get_basic_token_info(client: AsyncClient, mint: str):
+    pre = {b["accountIndex"]: b for b in (meta.get("preTokenBalances") or [])}
+    for post in (meta.get("postTokenBalances") or []):
+        pre_bal = pre.get(post["accountIndex"])
+        if (post["uiTokenAmount"]["uiAmount"] == 1.0 and
+            (not pre_bal or pre_bal["uiTokenAmount"]["uiAmount"] == 0)):
+            mint_str = post["mint"]
+            if len(mint_str) == 44:
+                # seen, token_db and CB_INDEX all share this one object
+                return sys.intern(mint_str)
+    return None
+
+async def get_basic_token_info(rpc: RpcHealth, mint: str):
     """Get basic token information including FDV estimation"""
     try:
-        pubkey = Pubkey.from_string(mint)
-        supply_resp = await client.get_token_supply(pubkey)
-       
-        if supply_resp.value:
-            supply_amount = supply_resp.value.amount
-            decimals = supply_resp.value.decimals
-            supply = supply_amount / (10 ** decimals)
-           
-            estimated_price = 0.00005
-            fdv = supply * estimated_price * 1000000
-           
-            return {
-                "fdv": max(1000, min(fdv, 3000000)),
-                "liquidity": fdv * random.uniform(0.20, 0.40),
-                "holders": random.randint(8, 75),
-                "symbol": f"TOKEN_{mint[:6].upper()}"
-            }
-        return None
+        supply_resp = await rpc_call(rpc, "getTokenSupply", [mint])
+        if not supply_resp or not supply_resp.get("value"):
+            return None
+        value = supply_resp["value"]
+        supply = int(value["amount"]) / (10 ** value["decimals"])
+
+        estimated_price = 0.00005
+        fdv = supply * estimated_price * 1000000
+
+        return {
+            "fdv": max(1000, min(fdv, 3000000)),
+            "liquidity": fdv * random.uniform(0.20, 0.40),
+            "holders": random.randint(8, 75),
+            "symbol": f"TOKEN_{mint[:6].upper()}"
+        }
     except Exception as e:
-        log.error(f"Error getting token info for {mint}: {e}")
+        log.error("Error getting token info for %s: %s", mint, e)
         return None
 
+CHECK_SEM = asyncio.Semaphore(5)
+
 async def process_token(mint: str, now: float):
     """Process a token through filtering criteria"""
-    if mint not in token_db or token_db[mint]["alerted"]:
+    info = token_db.get(mint)
+    if info is None or info.alerted:
         return
 
-    info = token_db[mint]
-    age = int(now - info["launched"])
+    age = int(now - info.launched)
 
-    # If we only have the placeholder FDV from RPC scanner → replace with realistic temp value
-    if info["fdv"] == 50000:  # placeholder value from earlier
-        info["fdv"] = random.uniform(15000, 800000)  # temporary realistic FDV
+    # Per-token lookups (FDV, holders) go under CHECK_SEM so a batch can't stampede the RPCs
+    async with CHECK_SEM:
+        # If we only have the placeholder FDV from RPC scanner → replace with realistic temp value
+        if info.fdv == 50000:  # placeholder value from earlier
+            info.fdv = random.uniform(15000, 800000)  # temporary realistic FDV
 
-    fdv = info["fdv"]
+    fdv = info.fdv
 
     # ——— YOUR FILTERS ———
-    if not (5000 <= fdv <= 2_000_000):
+    if not (MIN_FDVS_SNIPE <= fdv <= MAX_FDVS_SNIPE):
         return
 
-    if age > 600:  # older than 10 minutes
+    if age > MAX_AGE_SECONDS:
         return
 
-    if info.get("holders", 0) < 5:
+    if info.holders < MIN_HOLDERS:
         return
 
     # ——— TOKEN PASSED ALL FILTERS ———
-    token_db[mint]["alerted"] = True
-    symbol = info.get("symbol", "NEW_TOKEN")[:15]
+    info.alerted = True
+    symbol = info.symbol[:15]
 
-    log.info(f"PASSING FILTERS → {symbol} | FDV ${fdv:,.0f} | Age {age}s | {short_addr(mint)}")
-    await broadcast_alert(mint, symbol, int(fdv), age // 60)
+    if log.isEnabledFor(logging.INFO):
+        log.info("PASSING FILTERS → %s | FDV $%s | Age %ds | %s", symbol, f"{fdv:,.0f}", age, info.short)
+    await broadcast_alert(mint, symbol, int(fdv), age // 60, info.short)
 
 async def premium_pump_scanner():
     log.info("🚀 STARTING HELIUS RPC SCANNER – REAL-TIME PUMP.FUN LAUNCHES")
-    client = AsyncClient(RPC_URL)
     cycle = 0
-    while True:
+    while not STOP.is_set():
         cycle += 1
-        log.info(f"── SCANNER CYCLE {cycle} ({datetime.now().strftime('%H:%M:%S')}) ──")
+        log.info("── SCANNER CYCLE %d (%s) ──", cycle, datetime.now().strftime('%H:%M:%S'))
         try:
-            added = await get_new_tokens_rpc(client)
-            log.info(f"Found {added} new launches this cycle")
-
             now = time.time()
-            processed = 0
-            for mint in list(ready_queue):
-                if processed >= 5:
-                    break
-                await process_token(mint, now)
-                processed += 1
-
-            log.info(f"Processed {processed} tokens | Queue: {len(ready_queue)}")
+            if not stream_live.is_set():
+                added = await get_new_tokens_rpc(pick_rpc(), now)
+                log.info("Found %d new launches this cycle | Checking: %d", added, len(CHECKS))
         except Exception as e:
-            log.error(f"Cycle {cycle} failed: {e}")
+            log.error("Cycle %d failed: %s", cycle, e)
 
         await asyncio.sleep(15)  # scan every 15s (Helius free tier friendly)
-    await client.close()
 # ---------------------------------------------------------------------------
 # ALERTS
 # ---------------------------------------------------------------------------
-async def broadcast_alert(mint: str, sym: str, fdv: float, age_min: int):
+ALERT_BUY_AMOUNTS = ("0.1", "0.3", "0.5")
+BROADCAST_SEM = asyncio.Semaphore(25)  # in-flight sends; AIORateLimiter enforces the 30 msg/s cap
+ALERT_INFLIGHT: set[tuple[int, str]] = set()  # (chat_id, mint) sends not yet finished
+
+async def broadcast_alert(mint: str, sym: str, fdv: float, age_min: int, short: str):
     age_str = f" ({age_min}m old)" if age_min > 5 else ""
-    msg = f"<b>GOLD ALERT</b>{age_str}\n<code>{sym}</code>\nCA: <code>{short_addr(mint)}</code>\nFDV: <code>${fdv:,.0f}</code>"
+    msg = f"<b>GOLD ALERT</b>{age_str}\n<code>{sym}</code>\nCA: <code>{short}</code>\nFDV: <code>${fdv:,.0f}</code>"
+    tok = cb_token(mint)
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("0.1 SOL", callback_data=f"buy_{mint}_0.1"),
-         InlineKeyboardButton("0.3 SOL", callback_data=f"buy_{mint}_0.3"),
-         InlineKeyboardButton("0.5 SOL", callback_data=f"buy_{mint}_0.5")],
-        [InlineKeyboardButton("Custom Amount", callback_data=f"custom_buy_{mint}")],
-        [InlineKeyboardButton("Copy CA", callback_data=f"copy_{mint}")]
+        [InlineKeyboardButton(f"{amount} SOL", callback_data=f"b:{tok}:{amount}") for amount in ALERT_BUY_AMOUNTS],
+        [InlineKeyboardButton("Custom Amount", callback_data=f"cb:{tok}")],
+        [InlineKeyboardButton("Copy CA", callback_data=f"c:{tok}")]
     ])
-    for uid, u in list(users.items()):
-        if u.get("paid") or u.get("free_alerts", 0) > 0:
-            try:
-                await app.bot.send_message(u["chat_id"], msg, reply_markup=kb, parse_mode=ParseMode.HTML)
-                if not u.get("paid"):
-                    u["free_alerts"] -= 1
-            except:
-                pass
+
+    async def _send(uid):
+        u = users[uid]
+        key = (u.chat_id, mint)
+        if key in ALERT_INFLIGHT:  # a double trigger for this chat is already sending
+            return
+        ALERT_INFLIGHT.add(key)
+        try:
+            async with BROADCAST_SEM:
+                # Broadcasts overlap, so re-check and take the credit before awaiting the
+                # send; another alert may have spent the last one since ELIGIBLE was read
+                if not (u.paid or u.free_alerts > 0):
+                    return
+                debit = not u.paid
+                if debit:
+                    u.free_alerts -= 1
+                    _recompute_eligibility(uid)
+                try:
+                    await app.bot.send_message(u.chat_id, msg, reply_markup=kb, parse_mode=ParseMode.HTML)
+                except Exception:
+                    if debit:  # not delivered, so hand the credit back
+                        u.free_alerts += 1
+                        _recompute_eligibility(uid)
+                    return
+                if debit:
+                    mark_dirty(uid)
+        finally:
+            ALERT_INFLIGHT.discard(key)
+
+    await asyncio.gather(*(_send(uid) for uid in list(ELIGIBLE)), return_exceptions=True)
 
 # ---------------------------------------------------------------------------
 # FAKE AUTO-SELL (for trust)
 # ---------------------------------------------------------------------------
 async def check_auto_sell():
-    while True:
+    while not STOP.is_set():
         await asyncio.sleep(30)
-        for uid, u in users.items():
-            for trade in u.get("trades", []):
-                if trade["status"] != "open": continue
-                mult = random.uniform(0.5, 4.0)
-                if mult >= trade["tp"] or mult <= (1 - trade["sl"]):
-                    profit = trade["cost_usd"] * (mult - 1)
-                    fee = profit * 0.01
-                    data["revenue"] += fee
-                    if mult >= 1.5: data["wins"] += 1
-                    trade.update({"status": "sold", "profit": profit - fee})
-                    await app.bot.send_message(u["chat_id"], f"<b>AUTO-SELL</b>\nPnL: <code>{fmt_usd(profit - fee)}</code>")
+        uniform = random.uniform
+        # Walk backwards so sold entries can be popped without disturbing the rest
+        for i in reversed(range(len(OPEN_TRADES))):
+            uid, trade = OPEN_TRADES[i]
+            mult = uniform(0.5, 4.0)
+            if mult >= trade.tp or mult <= (1 - trade.sl):
+                profit = trade.cost_usd * (mult - 1)
+                fee = profit * 0.01
+                data["revenue"] += fee
+                if mult >= 1.5: data["wins"] += 1
+                trade.status = "sold"
+                trade.profit = profit - fee
+                OPEN_TRADES.pop(i)
+                mark_dirty(uid)
+                await app.bot.send_message(users[uid].chat_id, f"<b>AUTO-SELL</b>\nPnL: <code>{fmt_usd(profit - fee)}</code>")
 
 # ---------------------------------------------------------------------------
 # TEXT HANDLER (custom buy)
@@ -634,11 +1089,12 @@ async def handle_text(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     text = update.message.text.strip()
     u = users[uid]
-    if u.get("pending_buy"):
+    if u.pending_buy:
         try:
             amount = float(text)
             if amount <= 0: raise ValueError
-            mint = u.pop("pending_buy")
+            mint, u.pending_buy = u.pending_buy, None
+            mark_dirty(uid)
             await jupiter_buy(uid, mint, amount)
         except:
             await update.message.reply_text("Invalid amount. Send a number > 0.")
@@ -651,13 +1107,13 @@ async def safe_edit(query, text, reply_markup=None):
             await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
     except Exception as e:
         if "not modified" not in str(e).lower():
-            log.error(f"Edit failed: {e}")
+            log.error("Edit failed: %s", e)
 
 # ---------------------------------------------------------------------------
 # MAIN
 # ---------------------------------------------------------------------------
 async def watchlist_monitor():
-    while True:
+    while not STOP.is_set():
         await asyncio.sleep(RECHECK_INTERVAL)
         now = time.time()
         to_remove = []
@@ -668,7 +1124,9 @@ async def watchlist_monitor():
 
             # Drop if older than 15 min
             if age > WATCH_DURATION:
-                log.info(f"WATCHLIST DROP (15min expired): {token_db.get(mint, {}).get('symbol', '??')} | {short_addr(mint)}")
+                info = token_db.get(mint)
+                log.info("WATCHLIST DROP (15min expired): %s | %s",
+                         info.symbol if info else "??", info.short if info else short_addr(mint))
                 to_remove.append(mint)
                 continue
 
@@ -685,7 +1143,12 @@ async def main():
         print("Starting Onion X Bot...")
         
         global app
-        app = Application.builder().token(BOT_TOKEN).build()
+        app = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1))
+            .build()
+        )
         print("Application created successfully")
 
         # Add handlers
@@ -704,33 +1167,74 @@ async def main():
 
         # Start background tasks
         print("Starting background tasks...")
-        asyncio.create_task(premium_pump_scanner())
-        asyncio.create_task(auto_save())
-        asyncio.create_task(check_auto_sell())
-        asyncio.create_task(watchlist_monitor())
+        app.bot_data["saver"] = asyncio.create_task(auto_save())
+        global HTTP
+        HTTP = open_http()
+        RPC_CLIENTS.extend(RpcHealth(url) for url in [RPC_URL, *RPC_POOL])
+        app.bot_data["bg_tasks"] = [
+            asyncio.create_task(pump_log_stream()),
+            asyncio.create_task(premium_pump_scanner()),
+            asyncio.create_task(check_auto_sell()),
+            asyncio.create_task(watchlist_monitor()),
+        ]
         print("All background tasks started")
 
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, STOP.set)
+            except NotImplementedError:  # Windows: no loop signal handlers
+                signal.signal(sig, lambda *_: loop.call_soon_threadsafe(STOP.set))
+
         # Start polling
         print("Starting message polling...")
         await app.updater.start_polling()
         print("Bot is now running and polling for messages")
 
-        # Keep the bot running
-        await asyncio.Event().wait()
+        # Keep the bot running until SIGINT/SIGTERM
+        await STOP.wait()
         
     except Exception as e:
         print(f"ERROR: Bot failed to start: {e}")
         import traceback
         traceback.print_exc()
         raise
-async def test_imports():
-    from solders.transaction_status import UiTransactionStatusMeta
-    log.info("✅ SOLDERS FIXED – UiTransactionStatusMeta imported successfully")
-asyncio.create_task(test_imports())
+    finally:
+        await shutdown()
+
+async def shutdown():
+    """Stop background loops, flush state to disk and close network clients."""
+    STOP.set()
+    tasks = [*(app.bot_data.get("bg_tasks", []) if app else []), *CHECKS]
+    for task in tasks:
+        task.cancel()
+    saver = app.bot_data.get("saver") if app else None
+    await asyncio.gather(*tasks, *([saver] if saver else []), return_exceptions=True)
+
+    write_data(snapshot(), durable=True)
+    try:
+        write_bloom(SEEN_BLOOM.save_bytes())
+    except Exception as e:
+        log.error("Bloom save failed: %s", e)
+    print("State saved")
+
+    if HTTP:
+        await HTTP.close()
+    if app:
+        if app.updater and app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
 
 if __name__ == "__main__":
     try:
         print("Bot startup beginning...")
+        try:
+            import uvloop  # not available on Windows; fall back to the stock loop
+            uvloop.install()
+        except ImportError:
+            pass
         asyncio.run(main())
     except KeyboardInterrupt:
         print("Bot was stopped by user")
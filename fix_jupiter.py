@@ -6,10 +6,12 @@ import sys
 sdk_path = os.path.join(os.path.dirname(sys.executable), '..', 'site-packages', 'jupiter_python_sdk', '__init__.py')
 
 if os.path.exists(sdk_path):
-    content = open(sdk_path, 'r').read()
-    if 'from .jupiter import Jupiter' not in content:
-        with open(sdk_path, 'a') as f:
-            f.write('\nfrom .jupiter import Jupiter\n')
+    needle = b'from .jupiter import Jupiter'
+    with open(sdk_path, 'rb') as f:
+        found = any(needle in line for line in f)  # stops at the first match
+    if not found:
+        with open(sdk_path, 'ab') as f:
+            f.write(b'\n' + needle + b'\n')
         print("Patched jupiter_python_sdk.__init__.py")
 else:
     print("Warning: jupiter_python_sdk not found – install may have failed")